@@ -7,51 +7,55 @@ Application
 """
 
 import sys
-import struct
+import socket
+from collections import OrderedDict
 
 from bacpypes.debugging import bacpypes_debugging, ModuleLogger
 
 from bacpypes.comm import PDU, Client, Server, ApplicationServiceElement, bind
-from bacpypes.tcp import TCPClientDirector, TCPServerDirector, StreamToPacket
-from bacpypes.iocb import SieveClientController, CTRL_IDLE, ABORTED
+from bacpypes.tcp import TCPClientDirector, TCPServerDirector, TCPServerActor, StreamToPacket
+from bacpypes.iocb import IOController, IOQueue, ABORTED
 
-from .pdu import MPDU, request_types, response_types, ExceptionResponse
+from .pdu import MPDU, request_table, response_table, ExceptionResponse
 
 # some debugging
 _debug = 0
 _log = ModuleLogger(globals())
 
+# Python 2 indexes into a string as a string
+_py2 = (sys.version_info[0] == 2)
+
 
 #
 #   ModbusException
 #
 
+# text for the exception codes
+_exceptionText = {
+    ExceptionResponse.ILLEGAL_FUNCTION: "illegal function",
+    ExceptionResponse.ILLEGAL_DATA_ADDRESS: "illegal data address",
+    ExceptionResponse.ILLEGAL_DATA_VALUE: "illegal data value",
+    ExceptionResponse.ILLEGAL_RESPONSE_LENGTH: "illegal response length",
+    ExceptionResponse.ACKNOWLEDGE: "acknowledge",
+    ExceptionResponse.SLAVE_DEVICE_BUSY: "slave device busy",
+    ExceptionResponse.NEGATIVE_ACKNOWLEDGE: "negative acknowledge",
+    ExceptionResponse.MEMORY_PARITY_ERROR: "memory parity error",
+    ExceptionResponse.GATEWAY_PATH_UNAVAILABLE:
+    "gateway path unavailable",
+    ExceptionResponse.GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND:
+    "gateway target device failed to respond",
+    }
+
 
 class ModbusException(RuntimeError):
 
     """Helper class for exceptions."""
 
-    _exceptionText = {
-        ExceptionResponse.ILLEGAL_FUNCTION: "illegal function",
-        ExceptionResponse.ILLEGAL_DATA_ADDRESS: "illegal data address",
-        ExceptionResponse.ILLEGAL_DATA_VALUE: "illegal data value",
-        ExceptionResponse.ILLEGAL_RESPONSE_LENGTH: "illegal response length",
-        ExceptionResponse.ACKNOWLEDGE: "acknowledge",
-        ExceptionResponse.SLAVE_DEVICE_BUSY: "slave device busy",
-        ExceptionResponse.NEGATIVE_ACKNOWLEDGE: "negative acknowledge",
-        ExceptionResponse.MEMORY_PARITY_ERROR: "memory parity error",
-        ExceptionResponse.GATEWAY_PATH_UNAVAILABLE:
-        "gateway path unavailable",
-        ExceptionResponse.GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND:
-        "gateway target device failed to respond",
-        }
+    _exceptionText = _exceptionText
 
     def __init__(self, errCode, *args):
         self.errCode = errCode
-        text = ModbusException._exceptionText.get(
-            errCode,
-            "unknown exception %d" % errCode,
-            )
+        text = _exceptionText.get(errCode) or ("unknown exception %d" % errCode)
         self.args = (text,) + args
 
 #
@@ -66,16 +70,83 @@ def stream_to_packet(data):
     :returns: a tuple of the data that is a packet with the remaining
         data, or ``None``
     """
-    if len(data) < 6:
+    datalen = len(data)
+    if datalen < 6:
         return None
 
     # unpack the length
-    pktlen = struct.unpack(">H", data[4:6])[0] + 6
-    if (len(data) < pktlen):
+    if _py2:
+        pktlen = (ord(data[4]) << 8) + ord(data[5]) + 6
+    else:
+        pktlen = (data[4] << 8) + data[5] + 6
+    if (datalen < pktlen):
         return None
 
     return (data[:pktlen], data[pktlen:])
 
+#
+#   ModbusStreamToPacket
+#
+
+@bacpypes_debugging
+class ModbusStreamToPacket(StreamToPacket):
+
+    """
+    This class is a :class:`bacpypes.tcp.StreamToPacket` that chops the
+    stream through a :class:`memoryview`, so a chunk carrying several
+    MODBUS packets is not copied again for each packet that is taken
+    off the front.  Only the packets and the leftover data are copied.
+    """
+
+    def __init__(self, fn=stream_to_packet, cid=None, sid=None):
+        if _debug: ModbusStreamToPacket._debug("__init__ %r cid=%r sid=%r", fn, cid, sid)
+        StreamToPacket.__init__(self, fn, cid, sid)
+
+    def packetize(self, pdu, streamBuffer):
+        if _debug: ModbusStreamToPacket._debug("packetize %r ...", pdu)
+
+        def chop(addr):
+            if _debug: ModbusStreamToPacket._debug("chop %r", addr)
+
+            # get the current downstream buffer
+            buff = memoryview(streamBuffer.get(addr, b'') + pdu.pduData)
+
+            # look for a packet
+            while 1:
+                packet = self.packetFn(buff)
+                if packet is None:
+                    break
+
+                yield PDU(packet[0].tobytes(),
+                    source=pdu.pduSource,
+                    destination=pdu.pduDestination,
+                    user_data=pdu.pduUserData,
+                    )
+                buff = packet[1]
+
+            # save what didn't get sent
+            streamBuffer[addr] = buff.tobytes()
+
+        # buffer related to the addresses
+        if pdu.pduSource:
+            for packet in chop(pdu.pduSource):
+                yield packet
+        if pdu.pduDestination:
+            for packet in chop(pdu.pduDestination):
+                yield packet
+
+#
+#   _reset_pdu
+#
+
+def _reset_pdu(pdu):
+    """
+    Empty the data of a PDU in place so it can be encoded again.
+
+    :param pdu: a :class:`bacpypes.comm.PDU`
+    """
+    del pdu.pduData[:]
+
 
 #
 #   ModbusClient
@@ -96,54 +167,61 @@ class ModbusClient(Client, Server):
 
         # create and bind the client side
         self.director = TCPClientDirector(**kwargs)
-        bind(self, StreamToPacket(stream_to_packet), self.director)
+        bind(self, ModbusStreamToPacket(stream_to_packet), self.director)
+
+        # scratch PDUs reused for every message
+        self._encode_pdu = PDU()
+        self._decode_mpdu = MPDU()
 
     def indication(self, req):
         """Got a request from the application."""
-        if _debug: ModbusClient._debug("indication %r", req)
+        _d = _debug
+        if _d: ModbusClient._debug("indication %r", req)
 
-        # encode it as a generic MPDU
-        mpdu = MPDU()
-        req.encode(mpdu)
-        if _debug: ModbusClient._debug("    - mpdu: %r", mpdu)
+        # there is no point checking the director for a connection to the
+        # destination first, it opens one on demand and connection failures
+        # come back through ModbusClientASE which aborts the requests
 
-        # encode it as a PDU
-        pdu = PDU()
-        mpdu.encode(pdu)
-        if _debug: ModbusClient._debug("    - pdu: %r", pdu)
+        # encode it directly as a PDU
+        pdu = self._encode_pdu
+        _reset_pdu(pdu)
+        req.encode_to_pdu(pdu)
+        if _d: ModbusClient._debug("    - pdu: %r", pdu)
 
         # pass it along to the device
         self.request(pdu)
 
     def confirmation(self, pdu):
         """Got a response from the server."""
-        if _debug: ModbusClient._debug("confirmation %r", pdu)
+        _d = _debug
+        if _d: ModbusClient._debug("confirmation %r", pdu)
 
-        # pass through errors
-        if isinstance(pdu, Exception):
+        # pass through errors, the stream delivers plain PDUs so only
+        # check anything else
+        if (pdu.__class__ is not PDU) and isinstance(pdu, Exception):
             self.response(pdu)
             return
 
         # generic decode
-        mpdu = MPDU()
+        mpdu = self._decode_mpdu
         mpdu.decode(pdu)
-        if _debug: ModbusClient._debug("    - mpdu: %r", mpdu)
+        if _d: ModbusClient._debug("    - mpdu: %r", mpdu)
 
         # we don't know anything but MODBUS
         if (mpdu.mpduProtocolID != 0):
             return
 
         # may be sending a problem
-        if (mpdu.mpduFunctionCode >= 128):
+        if mpdu.mpduFunctionCode & 0x80:
             klass = ExceptionResponse
         else:
-            klass = response_types.get(mpdu.mpduFunctionCode, None)
+            klass = response_table[mpdu.mpduFunctionCode]
             if not klass:
                 return
 
         resp = klass()
         resp.decode(mpdu)
-        if _debug: ModbusClient._debug("    - resp: %r", resp)
+        if _d: ModbusClient._debug("    - resp: %r", resp)
 
         # pass it along to the application
         self.response(resp)
@@ -180,16 +258,69 @@ class ModbusClientASE(ApplicationServiceElement):
             # tell the director to close
             self.elementService.disconnect(actor_error.peer)
 
+#
+#   ModbusClientQueue
+#
+
+class ModbusClientQueue:
+
+    """
+    The requests waiting to be sent to one server, and the ones that have
+    been sent and are waiting for a response by transaction identifier.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.ioQueue = IOQueue()
+        self.active = {}
+
+        # transaction identifiers wrap around skipping zero
+        self.nextTransactionID = 1
+        self.wrapped = False
+
+        # identifiers of sent requests that were aborted, their responses
+        # may still come back
+        self.aborted = set()
+
+    def issued(self, transactionID):
+        """Return true if the transaction identifier has been given to a
+        request sent to this server."""
+        if not (0 < transactionID <= 0xFFFF):
+            return False
+        return self.wrapped or (transactionID < self.nextTransactionID)
+
 #
 #   ModbusClientController
 #
 
 @bacpypes_debugging
-class ModbusClientController(SieveClientController):
+class ModbusClientController(Client, IOController):
+
+    """
+    This class sends requests to MODBUS servers and matches up the responses.
+    Up to *window* requests are outstanding to each server at a time, the
+    responses are matched to requests by the transaction identifier.  The
+    default of one request at a time is safe for devices and gateways that
+    do not support more than one transaction.
+
+    Like the rest of the stack this runs in the bacpypes core thread, other
+    threads submit requests with ``deferred(controller.request_io, iocb)``
+    and wait on the IOCB.
+    """
 
-    def __init__(self, connect_timeout=None, idle_timeout=None):
-        if _debug: ModbusClientController._debug("__init__")
-        SieveClientController.__init__(self)
+    # idle queues kept for servers that are polled again
+    maxQueues = 64
+
+    def __init__(self, connect_timeout=None, idle_timeout=None, window=1):
+        if _debug: ModbusClientController._debug("__init__ window=%r", window)
+        Client.__init__(self)
+        IOController.__init__(self)
+
+        # queues by server address, least recently used first
+        self.queues = OrderedDict()
+
+        # number of outstanding requests to a server
+        self.window = window
 
         # create and bind to a client which is already bound to a director
         self.client = ModbusClient(connect_timeout=connect_timeout, idle_timeout=idle_timeout)
@@ -200,20 +331,159 @@ class ModbusClientController(SieveClientController):
         self.client_ase = ModbusClientASE(self)
         bind(self.client_ase, self.client.director)
 
+    def process_io(self, iocb):
+        _d = _debug
+        if _d: ModbusClientController._debug("process_io %r", iocb)
+
+        # find the queue for the server, it moves to the most recently
+        # used end
+        address = iocb.args[0].pduDestination
+        queue = self.queues.pop(address, None)
+        if not queue:
+            queue = ModbusClientQueue(address)
+            self.forget_idle_queues()
+        self.queues[address] = queue
+        if _d: ModbusClientController._debug("    - queue: %r", queue)
+
+        # add it to the queue and send what the window allows
+        queue.ioQueue.put(iocb)
+        self.send_requests(queue)
+
+    def send_requests(self, queue):
+        """Send waiting requests until the window is full."""
+        _d = _debug
+        if _d: ModbusClientController._debug("send_requests %r", queue)
+
+        while len(queue.active) < self.window:
+            iocb = queue.ioQueue.get(block=0)
+            if not iocb:
+                break
+
+            # give the request the next transaction identifier for the server
+            transactionID = queue.nextTransactionID
+            queue.nextTransactionID = (transactionID % 0xFFFF) + 1
+            if queue.nextTransactionID == 1:
+                queue.wrapped = True
+            queue.aborted.discard(transactionID)
+
+            req = iocb.args[0]
+            req.mpduTransactionID = transactionID
+            if _d: ModbusClientController._debug("    - req: %r", req)
+
+            # it is active before it is sent, the response could come back
+            # before request() returns
+            self.active_io(iocb)
+            queue.active[transactionID] = iocb
+
+            try:
+                self.request(req)
+            except Exception as err:
+                if _d: ModbusClientController._debug("    - request error: %r", err)
+
+                # free its place in the window and try the next one
+                del queue.active[transactionID]
+                self.abort_io(iocb, err)
+
+    def confirmation(self, resp):
+        _d = _debug
+        if _d: ModbusClientController._debug("confirmation %r", resp)
+
+        # look up the queue
+        queue = self.queues.get(resp.pduSource, None)
+        if not queue:
+            if _d: ModbusClientController._debug("    - no queue")
+            return
+
+        # match the transaction, a server that does not echo the identifier
+        # can still be used one request at a time
+        transactionID = resp.mpduTransactionID
+        iocb = queue.active.pop(transactionID, None)
+        if not iocb:
+            if transactionID in queue.aborted:
+                if _d: ModbusClientController._debug("    - late response to an aborted request")
+                queue.aborted.discard(transactionID)
+                return
+            if queue.issued(transactionID) or (len(queue.active) != 1):
+                if _d: ModbusClientController._debug("    - no matching transaction")
+                return
+            _, iocb = queue.active.popitem()
+
+        # complete the request and fill the window again
+        self.complete_io(iocb, resp)
+        self.send_requests(queue)
+
+    def abort_io(self, iocb, err):
+        """Abort a request, and if it had been sent free its place in the
+        window for the next one."""
+        if _debug: ModbusClientController._debug("abort_io %r %r", iocb, err)
+
+        # still waiting to be sent
+        if iocb.ioQueue is not None:
+            iocb.ioQueue.remove(iocb)
+
+        # look for it in the outstanding requests
+        queue = self.queues.get(iocb.args[0].pduDestination, None)
+        transactionID = None
+        if queue:
+            for tid, active_iocb in queue.active.items():
+                if active_iocb is iocb:
+                    transactionID = tid
+                    break
+
+        # abort it
+        IOController.abort_io(self, iocb, err)
+
+        # remember it was sent so a late response is dropped rather than
+        # taken for another request, then fill the window again
+        if transactionID is not None:
+            del queue.active[transactionID]
+            queue.aborted.add(transactionID)
+            self.send_requests(queue)
+
+    def forget_idle_queues(self):
+        """Forget the least recently used idle queues when there are more
+        than maxQueues of them."""
+        if _debug: ModbusClientController._debug("forget_idle_queues")
+
+        excess = len(self.queues) - self.maxQueues + 1
+        if excess <= 0:
+            return
+
+        for address, queue in list(self.queues.items()):
+            if not queue.ioQueue.queue and not queue.active:
+                if _debug: ModbusClientController._debug("    - forget: %r", address)
+                del self.queues[address]
+
+                excess -= 1
+                if not excess:
+                    break
+
     def abort(self, address, err):
         if _debug: ModbusClientController._debug("abort %r %r", address, err)
 
         # look up the queue
-        queue = self.queues.get(address, None)
+        queue = self.queues.pop(address, None)
         if not queue:
             if _debug: ModbusClientController._debug("    - no queue: %r" % (address,))
             return
         if _debug: ModbusClientController._debug("    - queue: %r", queue)
 
-        # if it has an active iocb, abort it
-        if queue.active_iocb:
-            if _debug: ModbusClientController._debug("    - active_iocb: %r", queue.active_iocb)
-            iocb = queue.active_iocb
+        # the active iocbs
+        pending = list(queue.active.values())
+        queue.active = {}
+
+        # take the rest of the queue in one shot, the entries are
+        # (priority, iocb) tuples
+        for _, iocb in queue.ioQueue.queue:
+            # no longer in the queue
+            iocb.ioQueue = None
+            pending.append(iocb)
+        queue.ioQueue.queue = []
+        queue.ioQueue.notempty.clear()
+
+        # abort them all
+        for iocb in pending:
+            if _debug: ModbusClientController._debug("    - iocb: %r", iocb)
 
             # change the state
             iocb.ioState = ABORTED
@@ -222,24 +492,25 @@ class ModbusClientController(SieveClientController):
             # notify the client
             iocb.trigger()
 
-        # abort the rest in the queue
-        while True:
-            iocb = queue.ioQueue.get(block=0)
-            if not iocb:
-                break
-            if _debug: ModbusClientController._debug("    - iocb: %r", iocb)
+#
+#   ModbusServerActor
+#
 
-            # change the state
-            iocb.ioState = ABORTED
-            iocb.ioError = err
+@bacpypes_debugging
+class ModbusServerActor(TCPServerActor):
 
-            # notify the client
-            iocb.trigger()
+    """
+    This class is a :class:`bacpypes.tcp.TCPServerActor` that turns off
+    Nagle's algorithm on the accepted connection.  Responses are only a
+    few octets and the client is waiting for each one, so they should
+    not be held back waiting for more data.
+    """
+
+    def __init__(self, director, sock, peer):
+        if _debug: ModbusServerActor._debug("__init__ %r %r %r", director, sock, peer)
 
-        # if the queue is empty and idle, forget about the controller
-        if not queue.ioQueue.queue and not queue.active_iocb:
-            if _debug: ModbusClientController._debug("    - queue is empty")
-            del self.queues[address]
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        TCPServerActor.__init__(self, director, sock, peer)
 
 #
 #   ModbusServer
@@ -253,34 +524,44 @@ class ModbusServer(Client, Server):
         Client.__init__(self)
         Server.__init__(self)
 
+        # send responses as soon as they are written
+        kwargs.setdefault('actorClass', ModbusServerActor)
+
         # create and bind
         self.serverDirector = TCPServerDirector((host, port), **kwargs)
-        bind(self, StreamToPacket(stream_to_packet), self.serverDirector)
+        bind(self, ModbusStreamToPacket(stream_to_packet), self.serverDirector)
+
+        # scratch PDUs reused for every message, responses may be encoded
+        # while a request is still being decoded so they are kept apart
+        self._encode_pdu = PDU()
+        self._decode_mpdu = MPDU()
 
     def confirmation(self, pdu):
         """This is a request from a client."""
-        if _debug: ModbusServer._debug("confirmation %r", pdu)
+        _d = _debug
+        if _d: ModbusServer._debug("confirmation %r", pdu)
 
-        # pass through errors
-        if isinstance(pdu, Exception):
+        # pass through errors, the stream delivers plain PDUs so only
+        # check anything else
+        if (pdu.__class__ is not PDU) and isinstance(pdu, Exception):
             self.response(pdu)
             return
 
         # generic decoding
-        mpdu = MPDU()
+        mpdu = self._decode_mpdu
         mpdu.decode(pdu)
-        if _debug: ModbusServer._debug("    - mpdu: %r", mpdu)
+        if _d: ModbusServer._debug("    - mpdu: %r", mpdu)
 
         # we don't know anything but MODBUS
         if (mpdu.mpduProtocolID != 0):
             return
 
         # clients shouldn't be sending exceptions
-        if (mpdu.mpduFunctionCode >= 128):
+        if mpdu.mpduFunctionCode & 0x80:
             return
 
         # map the function code
-        klass = request_types.get(mpdu.mpduFunctionCode, None)
+        klass = request_table[mpdu.mpduFunctionCode]
         if not klass:
             # create an error for now
             resp = ExceptionResponse(
@@ -291,31 +572,30 @@ class ModbusServer(Client, Server):
             # match the transaction information
             resp.pduDestination = mpdu.pduSource
             resp.mpduTransactionID = mpdu.mpduTransactionID
-            if _debug: ModbusServer._debug("    - resp: %r", resp)
+            resp.mpduUnitID = mpdu.mpduUnitID
+            if _d: ModbusServer._debug("    - resp: %r", resp)
 
-            # return the response to the device
-            self.request(resp)
+            # encode it and return the response to the device
+            self.indication(resp)
+            return
 
         req = klass()
         req.decode(mpdu)
-        if _debug: ModbusServer._debug("    - req: %r", req)
+        if _d: ModbusServer._debug("    - req: %r", req)
 
         # pass it along to the application
         self.response(req)
 
     def indication(self, resp):
         """This is a response from the application."""
-        if _debug: ModbusServer._debug("indication %r", resp)
-
-        # encode as a generic MPDU
-        mpdu = MPDU()
-        resp.encode(mpdu)
-        if _debug: ModbusServer._debug("    - mpdu: %r", mpdu)
-
-        # encode as a generic PDU
-        pdu = PDU()
-        mpdu.encode(pdu)
-        if _debug: ModbusServer._debug("    - pdu: %r", pdu)
+        _d = _debug
+        if _d: ModbusServer._debug("indication %r", resp)
+
+        # encode directly as a PDU
+        pdu = self._encode_pdu
+        _reset_pdu(pdu)
+        resp.encode_to_pdu(pdu)
+        if _d: ModbusServer._debug("    - pdu: %r", pdu)
 
         # return the response to the device
         self.request(pdu)
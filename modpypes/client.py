@@ -10,7 +10,8 @@ read and write MODBUS PDUs.
 """
 
 import os
-import math
+import re
+import sys
 
 from bacpypes.debugging import bacpypes_debugging, ModuleLogger
 from bacpypes.consolecmd import ConsoleCmd
@@ -26,7 +27,7 @@ from .pdu import ExceptionResponse, \
     ReadMultipleRegistersRequest, ReadMultipleRegistersResponse, \
     WriteSingleCoilRequest, WriteSingleCoilResponse, \
     WriteSingleRegisterRequest, WriteSingleRegisterResponse, \
-    ModbusStruct
+    ModbusStruct, String, BigEndianString
 from .app import ModbusClientController
 
 # some debugging
@@ -36,6 +37,146 @@ _log = ModuleLogger(globals())
 # settings
 CONNECT_TIMEOUT = int(os.getenv('CONNECT_TIMEOUT', 0)) or None
 IDLE_TIMEOUT = int(os.getenv('IDLE_TIMEOUT', 0)) or None
+WINDOW = int(os.getenv('WINDOW', 1))
+
+# command arguments
+_read_args = re.compile(r"^\s*([^\s:]+(?::\d+)?)\s+(\d+)\s+([\d,-]+)(?:\s+(\d+))?\s*$")
+_write_args = re.compile(r"^\s*([^\s:]+(?::\d+)?)\s+(\d+)\s+(\d+)\s+(-?\d+)\s*$")
+
+# request classes by register type
+_read_request_types = {
+    0: ReadCoilsRequest,
+    1: ReadDiscreteInputsRequest,
+    3: ReadInputRegistersRequest,
+    4: ReadMultipleRegistersRequest,
+    }
+_write_request_types = {
+    0: WriteSingleCoilRequest,
+    4: WriteSingleRegisterRequest,
+    }
+
+# the most values one read request can ask for by register type
+_read_limits = {
+    0: 2000,
+    1: 2000,
+    3: 125,
+    4: 125,
+    }
+
+#
+#   _decode_address
+#
+
+# server addresses by the text they were decoded from
+_server_addresses = {}
+
+def _decode_address(addr):
+    """
+    Turn the text of a server address into an (address, port) tuple,
+    the port defaults to 502.  The same tuple is returned for the same
+    text so the controller queue lookups hit on identity.
+
+    :param addr: IP address with an optional port, like ``10.0.1.70:503``
+    :returns: the server address tuple
+    """
+    server_address = _server_addresses.get(addr)
+    if server_address is None:
+        if ':' in addr:
+            host, port = addr.split(':')
+            server_address = (host, int(port))
+        else:
+            server_address = (addr, 502)
+        _server_addresses[addr] = server_address
+
+    return server_address
+
+#
+#   _decode_register
+#
+
+def _decode_register(register):
+    """
+    Split a register in 5-digit or 6-digit format into its type prefix
+    and a zero-based address.
+
+    :param register: register number, like 40001 or 300001
+    :returns: a tuple of the register type and the zero-based address
+    """
+    if register < 1:
+        raise ValueError("registers start at 1")
+    elif register < 10000:
+        # must be a coil
+        registerType = 0
+    elif register < 100000:
+        registerType, register = divmod(register, 10000)
+    elif register < 1000000:
+        registerType, register = divmod(register, 100000)
+    else:
+        raise ValueError("5 or 6 digit addresses please")
+
+    return (registerType, register - 1)
+
+#
+#   _parse_reads
+#
+
+def _parse_reads(spec, rcount=1):
+    """
+    Parse a list of registers and register ranges, like
+    ``40001,40010-40012``, into the reads it asks for.
+
+    :param spec: comma separated registers or ``first-last`` ranges
+    :param rcount: number of registers to read for a single register
+    :returns: a list of (label, registerType, address, count) tuples
+    """
+    reads = []
+    for item in spec.split(','):
+        if '-' in item:
+            first, _, last = item.partition('-')
+            if (not first) or (not last) or ('-' in last):
+                raise ValueError("invalid register range: %s" % (item,))
+            registerType, address = _decode_register(int(first))
+            lastType, lastAddress = _decode_register(int(last))
+            if (lastType != registerType) or (lastAddress < address):
+                raise ValueError("invalid register range: %s" % (item,))
+            count = lastAddress - address + 1
+        else:
+            registerType, address = _decode_register(int(item))
+            count = rcount
+
+        reads.append((item, registerType, address, count))
+
+    return reads
+
+#
+#   _merge_reads
+#
+
+def _merge_reads(reads):
+    """
+    Combine reads of the same type that are next to or overlap each other
+    into as few requests as the MODBUS limits allow.
+
+    :param reads: a list of (label, registerType, address, count) tuples
+    :returns: a list of (registerType, address, count, parts) tuples where
+        the parts are the reads in the request with their offset into it
+    """
+    runs = []
+    for read in sorted(reads, key=lambda read: (read[1], read[2])):
+        label, registerType, address, count = read
+
+        if runs:
+            runType, runAddress, runCount, parts = runs[-1]
+            if (runType == registerType) and (address <= runAddress + runCount):
+                newCount = max(runCount, address + count - runAddress)
+                if newCount <= _read_limits.get(registerType, 0):
+                    parts.append((read, address - runAddress))
+                    runs[-1] = (runType, runAddress, newCount, parts)
+                    continue
+
+        runs.append((registerType, address, count, [(read, 0)]))
+
+    return runs
 
 #
 #   ConsoleClient
@@ -55,85 +196,91 @@ class ConsoleClient(ConsoleCmd):
         # save the controller
         self.controller = controller
 
-    def do_read(self, args):
-        """read <addr> <unitID> <register> [ <count> ]
-
-        :param addr: IP address of the MODBUS/TCP device or gateway
+        # the codecs to try on register values with the number of registers
+        # each one needs, strings take whatever is there and codecs that
+        # do not say are tried on anything
+        self._struct_codecs = tuple(
+            (dtype, codec, 1 if isinstance(codec, (String, BigEndianString))
+                else (getattr(codec, 'registerLength', None) or 1))
+            for dtype, codec in ModbusStruct.items()
+            )
+
+        # the codecs that fit a response, by the number of registers
+        self._codecs_by_count = {}
+
+    def _print_exception(self, resp):
+        print("  ::= " + str(resp))
+
+    def _print_bits(self, resp):
+        print("  ::= " + str(resp.bits))
+
+    def _print_registers(self, resp):
+        lines = ["  ::= " + str(resp.registers)]
+
+        # find the codecs that fit this many registers
+        registerCount = len(resp.registers)
+        codecs = self._codecs_by_count.get(registerCount)
+        if codecs is None:
+            codecs = self._codecs_by_count[registerCount] = tuple(
+                (dtype, codec)
+                for dtype, codec, registerLength in self._struct_codecs
+                if registerCount >= registerLength
+                )
+
+        for dtype, codec in codecs:
+            try:
+                value = codec.unpack(resp.registers)
+                lines.append("   " + dtype + " ::= " + str(value))
+            except Exception as err:
+                if _debug: ConsoleClient._debug("unpack exception %r: %r", codec, err)
+
+        # one write for all of the interpretations
+        lines.append("")
+        sys.stdout.write("\n".join(lines))
+
+    def _print_value(self, resp):
+        print("  ::= " + str(resp.value))
+
+    # response printing functions by response class
+    _response_handlers = {
+        ExceptionResponse: _print_exception,
+        ReadCoilsResponse: _print_bits,
+        ReadDiscreteInputsResponse: _print_bits,
+        ReadInputRegistersResponse: _print_registers,
+        ReadMultipleRegistersResponse: _print_registers,
+        WriteSingleCoilResponse: _print_value,
+        WriteSingleRegisterResponse: _print_value,
+        }
+
+    def print_response(self, resp):
+        """Print the contents of a response."""
+        if _debug: ConsoleClient._debug("print_response %r", resp)
+
+        # look up the exact class first, then its base classes
+        handler = self._response_handlers.get(type(resp))
+        if handler is None:
+            for klass in type(resp).__mro__[1:]:
+                handler = self._response_handlers.get(klass)
+                if handler is not None:
+                    break
+            else:
+                raise TypeError("unsupported response")
+
+        handler(self, resp)
+
+    def submit_request(self, req, server_address, unitID):
+        """Send a request to a device without waiting for the response.
+
+        :param req: the request
+        :param server_address: address and port of the device or gateway
         :param unitID: unit identifier
-        :param register: register in 5-digit or 6-digit format
-        :param count: number of registers to read, defaults to one
-
-        This command generates a :class:`ReadCoilsRequest`,
-        :class:`ReadDiscreteInputsRequest`, :class:`ReadInputRegistersRequest`,
-        or :class:`ReadMultipleRegistersRequest` depending on the address
-        prefix; 0, 1, 3, or 4.
+        :returns: the IOCB to pass to :meth:`wait_response`
         """
-        args = args.split()
-        if _debug: ConsoleClient._debug("do_read %r", args)
-
-        if (len(args) < 3):
-            print("address, unit and register required")
-            return
-
-        # get the address and unit, and register
-        addr, unitID, register = args[:3]
-
-        # address might have a port
-        if ':' in addr:
-            addr, port = addr.split(':')
-            server_address = (addr, int(port))
-        else:
-            server_address = (addr, 502)
-
-        # unit identifier
-        unitID = int(unitID)
-        if _debug: ConsoleClient._debug("    - addr, unitID: %r, %r", addr, unitID)
-
-        # get the register and count
-        register = int(register)
-        if len(args) == 4:
-            rcount = int(args[3])
-        else:
-            rcount = 1
-        if _debug: ConsoleClient._debug("    - register, rcount: %r, %r", register, rcount)
-
-        # decode the register into a type
-        digits = int(math.log10(register)) + 1
-        if digits <= 4:
-            # must be a coil
-            registerType = 0
-        elif digits == 5:
-            registerType = register // 10000
-            register = register % 10000
-        elif digits == 6:
-            registerType = register // 100000
-            register = register % 100000
-        else:
-            print("5 or 6 digit addresses please")
-            return
-        if _debug: ConsoleClient._debug("    - registerType, register: %r, %r", registerType, register)
-
-        # build a request
-        if registerType == 0:
-            # coil
-            req = ReadCoilsRequest(register - 1, rcount)
-        elif registerType == 1:
-            # discrete inputs
-            req = ReadDiscreteInputsRequest(register - 1, rcount)
-        elif registerType == 3:
-            # input register
-            req = ReadInputRegistersRequest(register - 1, rcount)
-        elif registerType == 4:
-            # holding register
-            req = ReadMultipleRegistersRequest(register - 1, rcount)
-        else:
-            print("unsupported register type")
-            return
+        if _debug: ConsoleClient._debug("submit_request %r %r %r", req, server_address, unitID)
 
         # set the destination
         req.pduDestination = server_address
         req.mpduUnitID = unitID
-        if _debug: ConsoleClient._debug("    - req: %r", req)
 
         # make an IOCB
         iocb = IOCB(req)
@@ -142,50 +289,121 @@ class ConsoleClient(ConsoleCmd):
         # submit the request via the main thread
         deferred(self.controller.request_io, iocb)
 
+        return iocb
+
+    def send_request(self, req, server_address, unitID):
+        """Send a request to a device and wait for the response.
+
+        :param req: the request
+        :param server_address: address and port of the device or gateway
+        :param unitID: unit identifier
+        :returns: the response, or ``None`` if there was an error
+        """
+        if _debug: ConsoleClient._debug("send_request %r %r %r", req, server_address, unitID)
+
+        return self.wait_response(self.submit_request(req, server_address, unitID))
+
+    def wait_response(self, iocb):
+        """Wait for the response to a request.
+
+        :param iocb: the IOCB from :meth:`submit_request`
+        :returns: the response, or ``None`` if there was an error
+        """
+        if _debug: ConsoleClient._debug("wait_response %r", iocb)
+
         # wait for the response
         iocb.wait()
 
         # exceptions
         if iocb.ioError:
             print("error: %r" % (iocb.ioError,))
-            return
+            return None
 
         # extract the response
         resp = iocb.ioResponse
         if _debug: ConsoleClient._debug("    - resp: %r", resp)
 
-        # read responses
-        if isinstance(resp, ExceptionResponse):
-            print("  ::= " + str(resp))
+        return resp
 
-        elif isinstance(resp, ReadCoilsResponse):
-            print("  ::= " + str(resp.bits))
+    def do_read(self, args):
+        """read <addr> <unitID> <register>[,<register>...] [ <count> ]
+
+        :param addr: IP address of the MODBUS/TCP device or gateway
+        :param unitID: unit identifier
+        :param register: register in 5-digit or 6-digit format, or a range
+            of them like ``40001-40010``, separated by commas
+        :param count: number of registers to read, defaults to one
 
-        elif isinstance(resp, ReadDiscreteInputsResponse):
-            print("  ::= " + str(resp.bits))
+        This command generates a :class:`ReadCoilsRequest`,
+        :class:`ReadDiscreteInputsRequest`, :class:`ReadInputRegistersRequest`,
+        or :class:`ReadMultipleRegistersRequest` depending on the address
+        prefix; 0, 1, 3, or 4.  When more than one register or range is
+        given, the ones that are next to each other are read with a single
+        request, and all of the requests are sent before waiting for the
+        responses, see the ``--window`` option.
+        """
+        _d = _debug
+        if _d: ConsoleClient._debug("do_read %r", args)
 
-        elif isinstance(resp, ReadInputRegistersResponse):
-            print("  ::= " + str(resp.registers))
+        match = _read_args.match(args)
+        if not match:
+            print("address, unit and register required")
+            return
+        addr, unitID, register, rcount = match.groups()
+        rcount = int(rcount) if rcount else 1
 
-            for dtype, codec in ModbusStruct.items():
-                try:
-                    value = codec.unpack(resp.registers)
-                    print("   " + dtype + " ::= " + str(value))
-                except Exception as err:
-                    if _debug: ConsoleClient._debug("unpack exception %r: %r", codec, err)
+        # address might have a port
+        server_address = _decode_address(addr)
 
-        elif isinstance(resp, ReadMultipleRegistersResponse):
-            print("  ::= " + str(resp.registers))
+        # unit identifier
+        unitID = int(unitID)
+        if _d: ConsoleClient._debug("    - addr, unitID: %r, %r", server_address, unitID)
 
-            for dtype, codec in ModbusStruct.items():
-                try:
-                    value = codec.unpack(resp.registers)
-                    print("   " + dtype + " ::= " + str(value))
-                except Exception as err:
-                    if _debug: ConsoleClient._debug("unpack exception %r: %r", codec, err)
-        else:
-            raise TypeError("unsupported response")
+        if _d: ConsoleClient._debug("    - register, rcount: %r, %r", register, rcount)
 
+        # decode the registers into types and group them into requests
+        try:
+            reads = _parse_reads(register, rcount)
+        except ValueError as err:
+            print(err)
+            return
+        runs = _merge_reads(reads)
+        if _d: ConsoleClient._debug("    - runs: %r", runs)
+
+        # build the requests
+        requests = []
+        for registerType, address, count, parts in runs:
+            klass = _read_request_types.get(registerType)
+            if not klass:
+                print("unsupported register type")
+                return
+            requests.append(klass(address, count))
+        if _d: ConsoleClient._debug("    - requests: %r", requests)
+
+        # send them all before waiting so they can be outstanding together
+        iocbs = [
+            self.submit_request(req, server_address, unitID)
+            for req in requests
+            ]
+
+        for iocb, (registerType, address, count, parts) in zip(iocbs, runs):
+            resp = self.wait_response(iocb)
+            if resp is None:
+                continue
+
+            # a single read gets the response as it is
+            if len(reads) == 1 or isinstance(resp, ExceptionResponse):
+                self.print_response(resp)
+                continue
+
+            # split the response back into the reads that were asked for
+            if isinstance(resp, (ReadCoilsResponse, ReadDiscreteInputsResponse)):
+                values = resp.bits
+            else:
+                values = resp.registers
+            for (label, _, _, partCount), offset in parts:
+                print(label + ":")
+                self.print_response(resp.__class__(values[offset:offset + partCount]))
 
     def do_write(self, args):
         """write <addr> <unitID> <register> <value>
@@ -199,95 +417,54 @@ class ConsoleClient(ConsoleCmd):
         or :class:`WriteSingleRegisterRequest` depending on the address
         prefix; 0 or 4.
         """
-        args = args.split()
-        if _debug: ConsoleClient._debug("do_write %r", args)
+        _d = _debug
+        if _d: ConsoleClient._debug("do_write %r", args)
 
-        if (len(args) < 3):
-            print("address, unit and register required")
+        match = _write_args.match(args)
+        if not match:
+            print("address, unit, register and value required")
             return
 
         # get the address and unit
-        addr, unitID, register, value = args
+        addr, unitID, register, value = match.groups()
 
         # address might have a port
-        if ':' in addr:
-            addr, port = addr.split(':')
-            server_address = (addr, int(port))
-        else:
-            server_address = (addr, 502)
+        server_address = _decode_address(addr)
 
         # unit identifier
         unitID = int(unitID)
-        if _debug: ConsoleClient._debug("    - addr, unitID: %r, %r", server_address, unitID)
+        if _d: ConsoleClient._debug("    - addr, unitID: %r, %r", server_address, unitID)
 
         # get the register and count
         register = int(register)
-        if _debug: ConsoleClient._debug("    - register: %r", register)
+        if _d: ConsoleClient._debug("    - register: %r", register)
 
         # decode the register into a type
-        digits = int(math.log10(register)) + 1
-        if digits <= 4:
-            # must be a coil
-            registerType = 0
-        elif digits == 5:
-            registerType = register // 10000
-            register = register % 10000
-        elif digits == 6:
-            registerType = register // 100000
-            register = register % 100000
-        else:
-            print("5 or 6 digit addresses please")
+        try:
+            registerType, register = _decode_register(register)
+        except ValueError as err:
+            print(err)
             return
-        if _debug: ConsoleClient._debug("    - registerType, register: %r, %r", registerType, register)
+        if _d: ConsoleClient._debug("    - registerType, register: %r, %r", registerType, register)
 
         # value
         value = int(value)
-        if _debug: ConsoleClient._debug("    - value: %r", value)
+        if _d: ConsoleClient._debug("    - value: %r", value)
 
         # build a request
-        if registerType == 0:
-            # coil
-            req = WriteSingleCoilRequest(register - 1, value)
-        elif registerType == 4:
-            # holding register
-            req = WriteSingleRegisterRequest(register - 1, value)
-        else:
+        klass = _write_request_types.get(registerType)
+        if not klass:
             print("unsupported register type")
             return
+        req = klass(register, value)
+        if _d: ConsoleClient._debug("    - req: %r", req)
 
-        # set the destination
-        req.pduDestination = server_address
-        req.mpduUnitID = unitID
-        if _debug: ConsoleClient._debug("    - req: %r", req)
-
-        # make an IOCB
-        iocb = IOCB(req)
-        if _debug: ConsoleClient._debug("    - iocb: %r", iocb)
-
-        # submit the request via the main thread
-        deferred(self.controller.request_io, iocb)
-
-        # wait for the response
-        iocb.wait()
-
-        # exceptions
-        if iocb.ioError:
-            print("error: %r" % (iocb.ioError,))
+        resp = self.send_request(req, server_address, unitID)
+        if resp is None:
             return
 
-        # extract the response
-        resp = iocb.ioResponse
-        if _debug: ConsoleClient._debug("    - resp: %r", resp)
-
-        # write responses
-        if isinstance(iocb.ioResponse, WriteSingleCoilResponse):
-            print("  ::= " + str(iocb.ioResponse.value))
-
-        elif isinstance(iocb.ioResponse, WriteSingleRegisterResponse):
-            print("  ::= " + str(iocb.ioResponse.value))
-
-        else:
-            raise TypeError("unsupported response")
+        # print the response
+        self.print_response(resp)
 
 #
 #   main
@@ -309,6 +486,13 @@ def main():
         default=IDLE_TIMEOUT,
         )
 
+    # outstanding requests
+    parser.add_argument(
+        "--window", type=int,
+        help="outstanding requests to a server (default {!r})".format(WINDOW),
+        default=WINDOW,
+        )
+
     # now parse the arguments
     args = parser.parse_args()
 
@@ -319,6 +503,7 @@ def main():
     this_controller = ModbusClientController(
         connect_timeout=args.connect_timeout,
         idle_timeout=args.idle_timeout,
+        window=args.window,
         )
     if _debug: _log.debug("    - this_controller: %r", this_controller)
 
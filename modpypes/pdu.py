@@ -21,42 +21,83 @@ _log = ModuleLogger(globals())
 request_types = {}
 response_types = {}
 
+# the same classes indexed by function code, codes with the high bit
+# set are exception responses so they do not have entries
+request_table = [None] * 128
+response_table = [None] * 128
+
 def register_request_type(klass):
     request_types[klass.functionCode] = klass
+    request_table[klass.functionCode] = klass
 
 def register_response_type(klass):
     response_types[klass.functionCode] = klass
+    response_table[klass.functionCode] = klass
 
 #
 #   Packing and Unpacking Functions
 #
 
+# octet values by the eight bits they hold, least significant bit first
+_octet_of_bits = dict(
+    (tuple(bool((value >> i) & 1) for i in range(8)), value)
+    for value in range(256)
+    )
+
 def _packBitsToString(bits):
-    barry = []
-    i = packed = 0
-    for bit in bits:
-        if bit:
-            packed += 128
-        i += 1
-        if i == 8:
-            barry.append(packed)
-            i = packed = 0
-        else:
-            packed >>= 1
-    if i > 0 and i < 8:
-        packed >>= 7 - i
-        barry.append(packed)
-    return struct.pack("B" * len(barry), *barry)
+    bits = [bool(bit) for bit in bits]
+    bits.extend([False] * (-len(bits) % 8))
+    return bytes(bytearray(
+        _octet_of_bits[tuple(bits[i:i + 8])]
+        for i in range(0, len(bits), 8)
+        ))
+
+# the eight bits of each octet value, least significant bit first
+_bits_of_octet = tuple(
+    tuple(bool((value >> i) & 1) for i in range(8))
+    for value in range(256)
+    )
 
 def _unpackBitsFromString(string):
-    barry = struct.unpack("B" * len(string), string)
     bits = []
-    for byte in barry:
-        for bit in range(8):
-            bits.append((byte & 1) == 1)
-            byte >>= 1
+    for octet in bytearray(string):
+        bits.extend(_bits_of_octet[octet])
     return bits
 
+# precompiled formats for blocks of registers, by byte order and count
+_register_blocks = {}
+
+def _register_block(count, byteorder=">"):
+    block = _register_blocks.get((byteorder, count))
+    if block is None:
+        block = _register_blocks[(byteorder, count)] = struct.Struct("%s%dH" % (byteorder, count))
+    return block
+
+# build the formats for every register count a read can return up front,
+# anything else is built the first time it is needed
+for _count in range(126):
+    _register_block(_count)
+del _count
+
+def _put_registers(pdu, registers):
+    pdu.put(len(registers) * 2)
+    pdu.put_data(_register_block(len(registers)).pack(*[reg & 0xFFFF for reg in registers]))
+
+def _get_registers(pdu):
+    datalen = pdu.get()
+    return list(_register_block(datalen // 2).unpack_from(pdu.get_data(datalen)))
+
+def _unpackStringFromOctets(octets):
+    value = octets.split(b'\x00', 1)[0]
+    if not isinstance(value, str):
+        value = value.decode('latin-1')
+    return value
+
+# precompiled formats for the codecs
+_two_registers = struct.Struct(">HH")
+_two_swapped_registers = struct.Struct("<HH")
+_float = struct.Struct(">f")
+
 #
 #   _Struct
 #
@@ -129,11 +170,8 @@ class Int(_Struct):
     def unpack(self, registers):
         if _debug: Int._debug("unpack %r", registers)
 
-        value = registers[0]
-        if (value & 0x8000):
-            value = (-1 << 16) | value
-
-        return value
+        # sign extend without a branch
+        return ((registers[0] + 0x8000) & 0xFFFF) - 0x8000
 
 @bacpypes_debugging
 class UnsignedInt(_Struct):
@@ -188,10 +226,7 @@ class DoubleInt(_Struct):
         if _debug: DoubleInt._debug("unpack %r", registers)
 
         value = (registers[0] << 16) | registers[1]
-        if (value & 0x80000000):
-            value = (-1 << 32) | value
-
-        return value
+        return ((value + 0x80000000) & 0xFFFFFFFF) - 0x80000000
 
 @bacpypes_debugging
 class UnsignedDoubleInt(_Struct):
@@ -236,19 +271,19 @@ class Real(_Struct):
                 BigEndianReal._error("coercion error: %r not a float", value)
                 value = 0.0
 
-        registers = struct.unpack(">HH", struct.pack(">f", value))
+        registers = _two_registers.unpack(_float.pack(value))
         return [registers[1], registers[0]]
 
     def unpack(self, registers):
         if _debug: Real._debug("unpack %r", registers)
 
-        value, = struct.unpack(">f", struct.pack(">HH", registers[1], registers[0]))
+        value, = _float.unpack(_two_registers.pack(registers[1], registers[0]))
         return value
 
 @bacpypes_debugging
 class ROCReal(_Struct):
 
-    registerLength = 1
+    registerLength = 2
 
     def pack(self, value):
         if _debug: ROCReal._debug("pack %r", value)
@@ -266,12 +301,8 @@ class ROCReal(_Struct):
     def unpack(self, registers):
         if _debug: ROCReal._debug("unpack %r", registers)
 
-        # byte-swap the registers
-        r0, r1 = registers
-        r0 = ((r0 & 0xFF00) >> 8) | ((r0 & 0x00FF) << 8)
-        r1 = ((r1 & 0xFF00) >> 8) | ((r1 & 0x00FF) << 8)
-
-        value, = struct.unpack(">f", struct.pack(">HH", r1, r0))
+        # packing little-endian byte-swaps the registers
+        value, = _float.unpack(_two_swapped_registers.pack(registers[1], registers[0]))
         return value
 
 @bacpypes_debugging
@@ -300,10 +331,7 @@ class BigEndianDoubleInt(_Struct):
         if _debug: BigEndianDoubleInt._debug("unpack %r", registers)
 
         value = (registers[1] << 16) | registers[0]
-        if (value & 0x80000000):
-            value = (-1 << 32) | value
-
-        return value
+        return ((value + 0x80000000) & 0xFFFFFFFF) - 0x80000000
 
 @bacpypes_debugging
 class BigEndianUnsignedDoubleInt(_Struct):
@@ -348,13 +376,13 @@ class BigEndianReal(_Struct):
                 BigEndianReal._error("coercion error: %r not a float", value)
                 value = 0.0
 
-        registers = struct.unpack(">HH", struct.pack(">f", value))
+        registers = _two_registers.unpack(_float.pack(value))
         return [registers[0], registers[1]]
 
     def unpack(self, registers):
         if _debug: BigEndianReal._debug("unpack %r", registers)
 
-        value, = struct.unpack(">f", struct.pack(">HH", registers[0], registers[1]))
+        value, = _float.unpack(_two_registers.pack(registers[0], registers[1]))
         return value
 
 @bacpypes_debugging
@@ -377,14 +405,8 @@ class String(_Struct):
     def unpack(self, registers):
         if _debug: String._debug("unpack %r", registers)
 
-        octets = []
-        for reg in registers:
-            octets.append(reg >> 8)
-            octets.append(reg & 0xFF)
-
-        value = ''.join(chr(c) for c in octets)
-        value = value[:value.find('\x00')]
-        return value
+        octets = _register_block(len(registers)).pack(*registers)
+        return _unpackStringFromOctets(octets)
 
 @bacpypes_debugging
 class BigEndianString(_Struct):
@@ -406,14 +428,8 @@ class BigEndianString(_Struct):
     def unpack(self, registers):
         if _debug: String._debug("unpack %r", registers)
 
-        octets = []
-        for reg in registers:
-            octets.append(reg & 0xFF)
-            octets.append(reg >> 8)
-
-        value = ''.join(chr(c) for c in octets)
-        value = value[:value.find('\x00')]
-        return value
+        octets = _register_block(len(registers), "<").pack(*registers)
+        return _unpackStringFromOctets(octets)
 
 #
 #   ModbusStruct
@@ -438,6 +454,22 @@ ModbusStruct = {
 #  MPCI
 #
 
+# the MBAP header and its length field
+_mbap_header = struct.Struct(">HHHBB")
+_mbap_length = struct.Struct(">H")
+
+def _update_mpci(pci, mpci):
+    """Copy the MODBUS protocol control information from *mpci* into
+    *pci*, which may be a plain PDU when encoding directly.  Python 2
+    does not allow calling MPCI.update() on something that is not an
+    MPCI."""
+    PCI.update(pci, mpci)
+    pci.mpduTransactionID = mpci.mpduTransactionID
+    pci.mpduProtocolID = mpci.mpduProtocolID
+    pci.mpduLength = mpci.mpduLength
+    pci.mpduUnitID = mpci.mpduUnitID
+    pci.mpduFunctionCode = mpci.mpduFunctionCode
+
 @bacpypes_debugging
 class MPCI(PCI, DebugContents):
 
@@ -478,12 +510,7 @@ class MPCI(PCI, DebugContents):
     def update(self, mpci):
         if _debug: MPCI._debug("update %r", mpci)
 
-        PCI.update(self, mpci)
-        self.mpduTransactionID = mpci.mpduTransactionID
-        self.mpduProtocolID = mpci.mpduProtocolID
-        self.mpduLength = mpci.mpduLength
-        self.mpduUnitID = mpci.mpduUnitID
-        self.mpduFunctionCode = mpci.mpduFunctionCode
+        _update_mpci(self, mpci)
 
     def encode(self, pdu):
         """Encode the contents into the PDU."""
@@ -491,11 +518,13 @@ class MPCI(PCI, DebugContents):
 
         PCI.update(pdu, self)
 
-        pdu.put_short(self.mpduTransactionID)
-        pdu.put_short(self.mpduProtocolID)
-        pdu.put_short(self.mpduLength)
-        pdu.put(self.mpduUnitID)
-        pdu.put(self.mpduFunctionCode)
+        pdu.put_data(_mbap_header.pack(
+            self.mpduTransactionID,
+            self.mpduProtocolID,
+            self.mpduLength,
+            self.mpduUnitID,
+            self.mpduFunctionCode,
+            ))
 
     def decode(self, pdu):
         """Decode the contents of the PDU."""
@@ -503,16 +532,35 @@ class MPCI(PCI, DebugContents):
 
         PCI.update(self, pdu)
 
-        self.mpduTransactionID = pdu.get_short()
-        self.mpduProtocolID = pdu.get_short()
-        self.mpduLength = pdu.get_short()
-        self.mpduUnitID = pdu.get()
-        self.mpduFunctionCode = pdu.get()
+        (self.mpduTransactionID, self.mpduProtocolID, self.mpduLength,
+            self.mpduUnitID, self.mpduFunctionCode) = \
+            _mbap_header.unpack_from(pdu.get_data(_mbap_header.size))
 
         # check the length
         if self.mpduLength != len(pdu.pduData) + 2:
             raise DecodingError("invalid length")
 
+    def encode_to_pdu(self, pdu):
+        """Encode the header and the contents directly into an empty PDU
+        without going through a generic :class:`MPDU`."""
+        if _debug: MPCI._debug("encode_to_pdu %r", pdu)
+
+        # header with a placeholder for the length
+        PCI.update(pdu, self)
+        pdu.put_data(_mbap_header.pack(
+            self.mpduTransactionID,
+            self.mpduProtocolID,
+            0,
+            self.mpduUnitID,
+            self.mpduFunctionCode,
+            ))
+
+        # the message specific contents
+        self.encode(pdu)
+
+        # the length covers the unit identifier and everything after it
+        _mbap_length.pack_into(pdu.pduData, 4, len(pdu.pduData) - 6)
+
 #
 #   MPDU
 #
@@ -537,11 +585,20 @@ class MPDU(MPCI, PDUData):
         MPCI.encode(self, pdu)
         pdu.put_data(self.pduData)
 
+    def encode_to_pdu(self, pdu):
+        if _debug: MPDU._debug("encode_to_pdu %r", pdu)
+
+        # already has the header fields
+        self.encode(pdu)
+
     def decode(self, pdu):
         if _debug: MPDU._debug("decode %r", pdu)
 
         MPCI.decode(self, pdu)
-        self.pduData = pdu.get_data(len(pdu.pduData))
+
+        # take the rest of the data rather than copying it
+        self.pduData = pdu.pduData
+        pdu.pduData = bytearray()
 
 #------------------------------
 
@@ -565,17 +622,15 @@ class ReadBitsRequestBase(MPCI, DebugContents):
     def encode(self, pdu):
         if _debug: ReadBitsRequestBase._debug("encode %r", pdu)
 
-        MPCI.update(pdu, self)
-        pdu.put_short(self.address)
-        pdu.put_short(self.count)
+        _update_mpci(pdu, self)
+        pdu.put_data(_two_registers.pack(self.address & 0xFFFF, self.count & 0xFFFF))
         pdu.mpduLength = len(pdu.pduData) + 2
 
     def decode(self, pdu):
         if _debug: ReadBitsRequestBase._debug("decode %r", pdu)
 
         MPCI.update(self, pdu)
-        self.address = pdu.get_short()
-        self.count = pdu.get_short()
+        self.address, self.count = _two_registers.unpack_from(pdu.get_data(4))
 
 @bacpypes_debugging
 class ReadBitsResponseBase(MPCI, DebugContents):
@@ -600,7 +655,7 @@ class ReadBitsResponseBase(MPCI, DebugContents):
     def encode(self, pdu):
         if _debug: ReadBitsResponseBase._debug("encode %r", pdu)
 
-        MPCI.update(pdu, self)
+        _update_mpci(pdu, self)
 
         stringbits = _packBitsToString(self.bits)
         if _debug: ReadBitsResponseBase._debug("    - stringbits: %r", stringbits)
@@ -637,17 +692,15 @@ class ReadRegistersRequestBase(MPCI, DebugContents):
     def encode(self, pdu):
         if _debug: ReadRegistersRequestBase._debug("encode %r", pdu)
 
-        MPCI.update(pdu, self)
-        pdu.put_short(self.address)
-        pdu.put_short(self.count)
+        _update_mpci(pdu, self)
+        pdu.put_data(_two_registers.pack(self.address & 0xFFFF, self.count & 0xFFFF))
         pdu.mpduLength = len(pdu.pduData) + 2
 
     def decode(self, pdu):
         if _debug: ReadRegistersRequestBase._debug("decode %r", pdu)
 
         MPCI.update(self, pdu)
-        self.address = pdu.get_short()
-        self.count = pdu.get_short()
+        self.address, self.count = _two_registers.unpack_from(pdu.get_data(4))
 
 @bacpypes_debugging
 class ReadRegistersResponseBase(MPCI, DebugContents):
@@ -672,20 +725,15 @@ class ReadRegistersResponseBase(MPCI, DebugContents):
     def encode(self, pdu):
         if _debug: ReadRegistersResponseBase._debug("encode %r", pdu)
 
-        MPCI.update(pdu, self)
-        pdu.put(len(self.registers) * 2)
-        for reg in self.registers:
-            pdu.put_short(reg)
+        _update_mpci(pdu, self)
+        _put_registers(pdu, self.registers)
         pdu.mpduLength = len(pdu.pduData) + 2
 
     def decode(self, pdu):
         if _debug: ReadRegistersResponseBase._debug("decode %r", pdu)
 
         MPCI.update(self, pdu)
-        datalen = pdu.get()
-        self.registers = []
-        for i in range(datalen // 2):
-            self.registers.append(pdu.get_short())
+        self.registers = _get_registers(pdu)
 
 @bacpypes_debugging
 class ReadWriteValueBase(MPCI, DebugContents):
@@ -708,17 +756,15 @@ class ReadWriteValueBase(MPCI, DebugContents):
     def encode(self, pdu):
         if _debug: ReadWriteValueBase._debug("encode %r", pdu)
 
-        MPCI.update(pdu, self)
-        pdu.put_short(self.address)
-        pdu.put_short(self.value)
+        _update_mpci(pdu, self)
+        pdu.put_data(_two_registers.pack(self.address & 0xFFFF, self.value & 0xFFFF))
         pdu.mpduLength = len(pdu.pduData) + 2
 
     def decode(self, pdu):
         if _debug: ReadWriteValueBase._debug("decode %r", pdu)
 
         MPCI.update(self, pdu)
-        self.address = pdu.get_short()
-        self.value = pdu.get_short()
+        self.address, self.value = _two_registers.unpack_from(pdu.get_data(4))
 
 #------------------------------
 
@@ -975,15 +1021,14 @@ class WriteMultipleCoilsRequest(MPCI, DebugContents):
         if coils is not None:
             self.coils = coils
         else:
-            self.coils = [False] * count
+            self.coils = [False] * (count or 0)
 
     def encode(self, pdu):
         if _debug: WriteMultipleCoilsRequest._debug("encode %r", pdu)
 
-        MPCI.update(pdu, self)
+        _update_mpci(pdu, self)
 
-        pdu.put_short(self.address)
-        pdu.put_short(self.count)
+        pdu.put_data(_two_registers.pack(self.address & 0xFFFF, self.count & 0xFFFF))
 
         stringbits = _packBitsToString(self.coils)
         pdu.put(len(stringbits))
@@ -995,8 +1040,7 @@ class WriteMultipleCoilsRequest(MPCI, DebugContents):
 
         MPCI.update(self, pdu)
 
-        self.address = pdu.get_short()
-        self.count = pdu.get_short()
+        self.address, self.count = _two_registers.unpack_from(pdu.get_data(4))
 
         datalen = pdu.get()
         coils = _unpackBitsFromString(pdu.get_data(datalen))
@@ -1026,17 +1070,15 @@ class WriteMultipleCoilsResponse(MPCI, DebugContents):
     def encode(self, pdu):
         if _debug: WriteMultipleCoilsResponse._debug("encode %r", pdu)
 
-        MPCI.update(pdu, self)
-        pdu.put_short(self.address)
-        pdu.put_short(self.count)
+        _update_mpci(pdu, self)
+        pdu.put_data(_two_registers.pack(self.address & 0xFFFF, self.count & 0xFFFF))
         pdu.mpduLength = len(pdu.pduData) + 2
 
     def decode(self, pdu):
         if _debug: WriteMultipleCoilsResponse._debug("decode %r", pdu)
 
         MPCI.update(self, pdu)
-        self.address = pdu.get_short()
-        self.count = pdu.get_short()
+        self.address, self.count = _two_registers.unpack_from(pdu.get_data(4))
 
 register_response_type(WriteMultipleCoilsResponse)
 
@@ -1072,13 +1114,10 @@ class WriteMultipleRegistersRequest(MPCI, DebugContents):
     def encode(self, pdu):
         if _debug: WriteMultipleRegistersRequest._debug("encode %r", pdu)
 
-        MPCI.update(pdu, self)
-        pdu.put_short(self.address)
-        pdu.put_short(self.count)
+        _update_mpci(pdu, self)
+        pdu.put_data(_two_registers.pack(self.address & 0xFFFF, self.count & 0xFFFF))
 
-        pdu.put(len(self.registers) * 2)
-        for reg in self.registers:
-            pdu.put_short(reg)
+        _put_registers(pdu, self.registers)
         pdu.mpduLength = len(pdu.pduData) + 2
 
     def decode(self, pdu):
@@ -1086,13 +1125,9 @@ class WriteMultipleRegistersRequest(MPCI, DebugContents):
 
         MPCI.update(self, pdu)
 
-        self.address = pdu.get_short()
-        self.count = pdu.get_short()
+        self.address, self.count = _two_registers.unpack_from(pdu.get_data(4))
 
-        datalen = pdu.get()
-        self.registers = []
-        for i in range(datalen // 2):
-            self.registers.append(pdu.get_short())
+        self.registers = _get_registers(pdu)
 
 register_request_type(WriteMultipleRegistersRequest)
 
@@ -1118,17 +1153,15 @@ class WriteMultipleRegistersResponse(MPCI, DebugContents):
     def encode(self, pdu):
         if _debug: WriteMultipleRegistersResponse._debug("encode %r", pdu)
 
-        MPCI.update(pdu, self)
-        pdu.put_short(self.address)
-        pdu.put_short(self.count)
+        _update_mpci(pdu, self)
+        pdu.put_data(_two_registers.pack(self.address & 0xFFFF, self.count & 0xFFFF))
         pdu.mpduLength = len(pdu.pduData) + 2
 
     def decode(self, pdu):
         if _debug: WriteMultipleRegistersResponse._debug("decode %r", pdu)
 
         MPCI.update(self, pdu)
-        self.address = pdu.get_short()
-        self.count = pdu.get_short()
+        self.address, self.count = _two_registers.unpack_from(pdu.get_data(4))
 
 register_response_type(WriteMultipleRegistersResponse)
 
@@ -1159,36 +1192,31 @@ class ReadWriteMultipleRegistersRequest(MPCI, DebugContents):
         if registers is not None:
             self.registers = registers
         else:
-            self.registers = [0] * wcount
+            self.registers = [0] * (wcount or 0)
 
     def encode(self, pdu):
         if _debug: ReadWriteMultipleRegistersRequest._debug("encode %r", pdu)
 
-        MPCI.update(pdu, self)
+        _update_mpci(pdu, self)
 
-        pdu.put_short(self.raddress)
-        pdu.put_short(self.rcount)
-        pdu.put_short(self.waddress)
-        pdu.put_short(self.wcount)
+        pdu.put_data(_register_block(4).pack(
+            self.raddress & 0xFFFF,
+            self.rcount & 0xFFFF,
+            self.waddress & 0xFFFF,
+            self.wcount & 0xFFFF,
+            ))
 
-        pdu.put(len(self.registers) * 2)
-        for reg in self.registers:
-            pdu.put_short(reg)
+        _put_registers(pdu, self.registers)
         pdu.mpduLength = len(pdu.pduData) + 2
 
     def decode(self, pdu):
         if _debug: ReadWriteMultipleRegistersRequest._debug("decode %r", pdu)
 
         MPCI.update(self, pdu)
-        self.raddress = pdu.get_short()
-        self.rcount = pdu.get_short()
-        self.waddress = pdu.get_short()
-        self.wcount = pdu.get_short()
+        self.raddress, self.rcount, self.waddress, self.wcount = \
+            _register_block(4).unpack_from(pdu.get_data(8))
 
-        datalen = pdu.get()
-        self.registers = []
-        for i in range(datalen // 2):
-            self.registers.append(pdu.get_short())
+        self.registers = _get_registers(pdu)
 
 register_request_type(ReadWriteMultipleRegistersRequest)
 
@@ -1216,20 +1244,15 @@ class ReadWriteMultipleRegistersResponse(MPCI, DebugContents):
     def encode(self, pdu):
         if _debug: ReadWriteMultipleRegistersResponse._debug("encode %r", pdu)
 
-        MPCI.update(pdu, self)
-        pdu.put(len(self.registers) * 2)
-        for reg in self.registers:
-            pdu.put_short(reg)
+        _update_mpci(pdu, self)
+        _put_registers(pdu, self.registers)
         pdu.mpduLength = len(pdu.pduData) + 2
 
     def decode(self, pdu):
         if _debug: ReadWriteMultipleRegistersResponse._debug("decode %r", pdu)
 
         MPCI.update(self, pdu)
-        datalen = pdu.get()
-        self.registers = []
-        for i in range(datalen // 2):
-            self.registers.append(pdu.get_short())
+        self.registers = _get_registers(pdu)
 
 register_response_type(ReadWriteMultipleRegistersResponse)
 
@@ -1270,7 +1293,7 @@ class ExceptionResponse(MPCI, DebugContents):
     def encode(self, pdu):
         if _debug: ExceptionResponse._debug("encode %r", pdu)
 
-        MPCI.update(pdu, self)
+        _update_mpci(pdu, self)
         pdu.put(self.exceptionCode)
         pdu.mpduLength = len(pdu.pduData) + 2
 
@@ -10,14 +10,14 @@ import os
 import logging
 
 from bacpypes.debugging import bacpypes_debugging, ModuleLogger
-from bacpypes.consolecmd import ConsoleCmd
 from bacpypes.consolelogging import ArgumentParser
 
 from bacpypes.comm import Client, bind
 from bacpypes.core import run
 
-from .pdu import ExceptionResponse, \
-    ReadCoilsResponse, ReadDiscreteInputsResponse, ReadMultipleRegistersResponse, \
+from .pdu import request_types, ExceptionResponse, \
+    ReadCoilsResponse, ReadDiscreteInputsResponse, \
+    ReadInputRegistersResponse, ReadMultipleRegistersResponse, \
     WriteSingleCoilResponse, WriteSingleRegisterResponse, WriteMultipleRegistersResponse
 from .app import ModbusServer, ModbusException
 
@@ -31,6 +31,12 @@ SERVER_HOST = os.getenv("SERVER_HOST", "")
 SERVER_PORT = int(os.getenv("SERVER_PORT", 502))
 IDLE_TIMEOUT = int(os.getenv('IDLE_TIMEOUT', 0)) or None
 
+# coil values by the value written in a write single coil request
+_coil_values = {
+    0x0000: 0,
+    0xFF00: 1,
+    }
+
 #
 #   SimpleServer
 #
@@ -43,21 +49,29 @@ class SimpleServer(Client):
     Simple Server
     """
 
-    def __init__(self, unitNumber=1):
+    def __init__(self, unitNumber=1, unitNumbers=None):
         if _debug: SimpleServer._debug("__init__")
         Client.__init__(self)
 
-        # save the unit number
+        # save the unit number, a gateway can answer for a set of them
+        # instead
         self.unitNumber = unitNumber
+        self.unitNumbers = frozenset(unitNumbers) if unitNumbers else None
 
         # create some coils and registers
         self.coils = [False] * 10
         self.registers = [0] * 10
 
+        # request handling functions by request class
+        self._request_handlers = {}
+        for klass in request_types.values():
+            fn = getattr(self, "do_" + klass.__name__, None)
+            if fn is not None:
+                self._request_handlers[klass] = fn
+
     def confirmation(self, req):
         """Got a request from a client."""
         if _debug: SimpleServer._debug("confirmation %r", req)
-        _commlog.debug(">>> %r %r", req.pduSource, req)
 
         # if its an exception, punt
         if isinstance(req, Exception):
@@ -65,15 +79,20 @@ class SimpleServer(Client):
             return
 
         # if it's not for us, dump it
-        if req.mpduUnitID != self.unitNumber:
+        if self.unitNumbers is None:
+            forUs = (req.mpduUnitID == self.unitNumber)
+        else:
+            forUs = (req.mpduUnitID in self.unitNumbers)
+        if not forUs:
             if _debug: SimpleServer._debug("    - not for us")
             return
 
+        _commlog.debug(">>> %r %r", req.pduSource, req)
+
         try:
             # look up a matching function
-            try:
-                fn = getattr(self, "do_" + req.__class__.__name__)
-            except AttributeError:
+            fn = self._request_handlers.get(type(req))
+            if fn is None:
                 raise ModbusException(ExceptionResponse.ILLEGAL_FUNCTION)
 
             # try to execute it
@@ -113,7 +132,7 @@ class SimpleServer(Client):
     # ---------- Coils ----------
 
     def do_ReadCoilsRequest(self, req):
-        SimpleServer._debug('do_ReadCoilsRequest %r', req)
+        if _debug: SimpleServer._debug('do_ReadCoilsRequest %r', req)
         if (req.address + req.count) > len(self.coils):
             raise ModbusException(ExceptionResponse.ILLEGAL_DATA_ADDRESS)
 
@@ -122,17 +141,15 @@ class SimpleServer(Client):
         return ReadCoilsResponse(self.coils[req.address:req.address+req.count])
 
     def do_WriteSingleCoilRequest(self, req):
-        SimpleServer._debug('do_WriteSingleCoilRequest %r', req)
+        if _debug: SimpleServer._debug('do_WriteSingleCoilRequest %r', req)
         if req.address > len(self.coils):
             raise ModbusException(ExceptionResponse.ILLEGAL_DATA_ADDRESS)
 
         # check the value and save it
-        if (req.value == 0x0000):
-            self.coils[req.address] = 0
-        elif (req.value == 0xFF00):
-            self.coils[req.address] = 1
-        else:
+        value = _coil_values.get(req.value)
+        if value is None:
             raise ModbusException(ExceptionResponse.ILLEGAL_DATA_VALUE)
+        self.coils[req.address] = value
 
         self.push_coils(req.address, 1)
 
@@ -142,7 +159,7 @@ class SimpleServer(Client):
     # ---------- Descrete Inputs (mapped as a coil) ----------
 
     def do_ReadDescreteInputsRequest(self, req):
-        SimpleServer._debug('do_ReadDescreteInputsRequest %r', req)
+        if _debug: SimpleServer._debug('do_ReadDescreteInputsRequest %r', req)
         if (req.address + req.count) > len(self.coils):
             raise ModbusException(ExceptionResponse.ILLEGAL_DATA_ADDRESS)
 
@@ -153,7 +170,7 @@ class SimpleServer(Client):
     # ---------- Registers ----------
 
     def do_ReadMultipleRegistersRequest(self, req):
-        SimpleServer._debug('do_ReadMultipleRegistersRequest %r', req)
+        if _debug: SimpleServer._debug('do_ReadMultipleRegistersRequest %r', req)
         if (req.address + req.count) > len(self.registers):
             raise ModbusException(ExceptionResponse.ILLEGAL_DATA_ADDRESS)
 
@@ -162,7 +179,7 @@ class SimpleServer(Client):
         return ReadMultipleRegistersResponse(self.registers[req.address:req.address+req.count])
 
     def do_WriteSingleRegisterRequest(self, req):
-        SimpleServer._debug('do_WriteSingleRegisterRequest %r', req)
+        if _debug: SimpleServer._debug('do_WriteSingleRegisterRequest %r', req)
         if req.address > len(self.registers):
             raise ModbusException(ExceptionResponse.ILLEGAL_DATA_ADDRESS)
 
@@ -175,13 +192,15 @@ class SimpleServer(Client):
         return WriteSingleRegisterResponse(req.address, req.value)
 
     def do_WriteMultipleRegistersRequest(self, req):
-        SimpleServer._debug('do_WriteMultipleRegistersRequest %r', req)
+        if _debug: SimpleServer._debug('do_WriteMultipleRegistersRequest %r', req)
         if (req.address + req.count) > len(self.registers):
             raise ModbusException(ExceptionResponse.ILLEGAL_DATA_ADDRESS)
 
+        if len(req.registers) != req.count:
+            raise ModbusException(ExceptionResponse.ILLEGAL_DATA_VALUE)
+
         # save the values
-        for i in range(req.count):
-            self.registers[req.address + i] = req.registers[i]
+        self.registers[req.address:req.address + req.count] = req.registers
 
         self.push_registers(req.address, req.count)
 
@@ -190,7 +209,7 @@ class SimpleServer(Client):
     # ---------- Input Registers (mapped as a register) ----------
 
     def do_ReadInputRegistersRequest(self, req):
-        SimpleServer._debug('do_ReadInputRegistersRequest %r', req)
+        if _debug: SimpleServer._debug('do_ReadInputRegistersRequest %r', req)
         if (req.address + req.count) > len(self.registers):
             raise ModbusException(ExceptionResponse.ILLEGAL_DATA_ADDRESS)
 
@@ -26,6 +26,9 @@ _log = ModuleLogger(globals())
 CONNECT_TIMEOUT = int(os.getenv("CONNECT_TIMEOUT", 0)) or None
 IDLE_TIMEOUT = int(os.getenv("IDLE_TIMEOUT", 0)) or None
 
+# the codecs to try on register values
+_codecs = tuple(ModbusStruct.items())
+
 #
 #   ReadClient
 #
@@ -82,7 +85,7 @@ class ReadClient(Client):
         elif isinstance(resp, ReadInputRegistersResponse):
             print("  ::= " + str(resp.registers))
 
-            for dtype, codec in ModbusStruct.items():
+            for dtype, codec in _codecs:
                 try:
                     value = codec.unpack(resp.registers)
                     print("   " + dtype + " ::= " + str(value))
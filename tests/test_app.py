@@ -10,7 +10,26 @@ Tests for `modpypes.app` module.
 
 import unittest
 
+from bacpypes.iocb import IOCB, PENDING, ACTIVE, COMPLETED, ABORTED
+
 from modpypes import app
+from modpypes.pdu import ReadMultipleRegistersRequest, ReadMultipleRegistersResponse
+
+SERVER = ('10.0.1.70', 502)
+
+
+def make_iocb(address=SERVER):
+    req = ReadMultipleRegistersRequest(0, 1)
+    req.pduDestination = address
+    req.mpduUnitID = 1
+    return IOCB(req)
+
+
+def make_response(transactionID, address=SERVER):
+    resp = ReadMultipleRegistersResponse([1])
+    resp.pduSource = address
+    resp.mpduTransactionID = transactionID
+    return resp
 
 
 class TestModpypes(unittest.TestCase):
@@ -21,6 +40,148 @@ class TestModpypes(unittest.TestCase):
     def test_something(self):
         pass
 
+    def test_stream_to_packet(self):
+        data = b'\x00\x01\x00\x00\x00\x03\x01\x03\x00' + b'\x00\x02'
+        self.assertIsNone(app.stream_to_packet(data[:5]))
+        self.assertIsNone(app.stream_to_packet(data[:8]))
+
+        packet, rest = app.stream_to_packet(data)
+        self.assertEqual(packet, data[:9])
+        self.assertEqual(rest, b'\x00\x02')
+
+        packet, rest = app.stream_to_packet(memoryview(data))
+        self.assertEqual(packet.tobytes(), data[:9])
+        self.assertEqual(rest.tobytes(), b'\x00\x02')
+
+    def make_controller(self, window=1):
+        """Make a controller that collects the requests it sends."""
+        controller = app.ModbusClientController(window=window)
+        controller.sent = []
+        controller.request = controller.sent.append
+        return controller
+
+    def test_controller_window(self):
+        controller = self.make_controller(window=2)
+        iocbs = [make_iocb() for i in range(3)]
+        for iocb in iocbs:
+            controller.request_io(iocb)
+
+        # two requests are outstanding, the third waits
+        self.assertEqual([req.mpduTransactionID for req in controller.sent], [1, 2])
+        self.assertEqual([iocb.ioState for iocb in iocbs], [ACTIVE, ACTIVE, PENDING])
+
+        # responses are matched by transaction, not by order
+        controller.confirmation(make_response(2))
+        self.assertEqual(iocbs[1].ioState, COMPLETED)
+        self.assertEqual(iocbs[0].ioState, ACTIVE)
+        self.assertEqual(iocbs[2].ioState, ACTIVE)
+        self.assertEqual(controller.sent[-1].mpduTransactionID, 3)
+
+        # an unknown transaction is dropped while more than one is active
+        controller.confirmation(make_response(99))
+        self.assertEqual(iocbs[0].ioState, ACTIVE)
+
+        controller.confirmation(make_response(1))
+        controller.confirmation(make_response(3))
+        self.assertEqual([iocb.ioState for iocb in iocbs], [COMPLETED] * 3)
+        self.assertEqual(controller.queues[SERVER].active, {})
+
+    def test_controller_send_error(self):
+        controller = self.make_controller()
+
+        def request(req):
+            if not controller.sent:
+                controller.sent.append(None)
+                raise ValueError("encoding error")
+            controller.sent.append(req)
+        controller.request = request
+
+        iocbs = [make_iocb() for i in range(2)]
+        for iocb in iocbs:
+            controller.request_io(iocb)
+
+        # the first one failed, the second one went out anyway
+        self.assertEqual(iocbs[0].ioState, ABORTED)
+        self.assertIsInstance(iocbs[0].ioError, ValueError)
+        self.assertEqual(iocbs[1].ioState, ACTIVE)
+        self.assertIs(controller.sent[-1], iocbs[1].args[0])
+
+    def test_controller_abort(self):
+        controller = self.make_controller()
+        iocbs = [make_iocb() for i in range(3)]
+        for iocb in iocbs:
+            controller.request_io(iocb)
+        self.assertEqual(len(controller.sent), 1)
+
+        # aborting a waiting request takes it out of the queue
+        iocbs[1].abort(RuntimeError("waiting"))
+        self.assertEqual(iocbs[1].ioState, ABORTED)
+        self.assertEqual(len(controller.sent), 1)
+
+        # aborting the active request sends the next one
+        iocbs[0].abort(RuntimeError("active"))
+        self.assertEqual(iocbs[0].ioState, ABORTED)
+        self.assertEqual(iocbs[2].ioState, ACTIVE)
+        self.assertEqual(controller.sent[-1].mpduTransactionID, 2)
+
+        controller.confirmation(make_response(2))
+        self.assertEqual(iocbs[2].ioState, COMPLETED)
+
+    def test_controller_late_response(self):
+        controller = self.make_controller()
+        iocbs = [make_iocb() for i in range(2)]
+        for iocb in iocbs:
+            controller.request_io(iocb)
+
+        # the first one times out and the second one goes out
+        iocbs[0].abort(RuntimeError("timeout"))
+        self.assertEqual(controller.sent[-1].mpduTransactionID, 2)
+
+        # the late response to the first one is not taken for the second
+        controller.confirmation(make_response(1))
+        self.assertEqual(iocbs[1].ioState, ACTIVE)
+
+        controller.confirmation(make_response(2))
+        self.assertEqual(iocbs[1].ioState, COMPLETED)
+
+    def test_controller_no_transaction_echo(self):
+        controller = self.make_controller()
+        iocb = make_iocb()
+        controller.request_io(iocb)
+
+        # a server that does not echo the identifier still completes the
+        # only outstanding request
+        controller.confirmation(make_response(0))
+        self.assertEqual(iocb.ioState, COMPLETED)
+
+    def test_controller_abort_address(self):
+        controller = self.make_controller()
+        iocbs = [make_iocb() for i in range(2)]
+        for iocb in iocbs:
+            controller.request_io(iocb)
+
+        controller.abort(SERVER, RuntimeError("connection lost"))
+        self.assertEqual([iocb.ioState for iocb in iocbs], [ABORTED] * 2)
+        self.assertNotIn(SERVER, controller.queues)
+
+    def test_controller_forget_idle_queues(self):
+        controller = self.make_controller()
+        controller.maxQueues = 2
+
+        addresses = [('10.0.1.%d' % i, 502) for i in range(1, 4)]
+        for address in addresses:
+            controller.request_io(make_iocb(address))
+            controller.confirmation(make_response(1, address))
+
+        # the least recently used idle queue is forgotten
+        self.assertEqual(list(controller.queues), addresses[1:])
+
+        # a busy queue is kept
+        controller.request_io(make_iocb(addresses[1]))
+        controller.request_io(make_iocb(addresses[0]))
+        self.assertEqual(list(controller.queues), [addresses[1], addresses[0]])
+        self.assertEqual(len(controller.queues[addresses[1]].active), 1)
+
     def tearDown(self):
         pass
 
@@ -21,6 +21,45 @@ class TestModpypes(unittest.TestCase):
     def test_something(self):
         pass
 
+    def test_decode_address(self):
+        self.assertEqual(client._decode_address('10.0.1.70'), ('10.0.1.70', 502))
+        self.assertEqual(client._decode_address('10.0.1.70:503'), ('10.0.1.70', 503))
+        self.assertIs(client._decode_address('10.0.1.70'), client._decode_address('10.0.1.70'))
+
+    def test_decode_register(self):
+        self.assertEqual(client._decode_register(1), (0, 0))
+        self.assertEqual(client._decode_register(10001), (1, 0))
+        self.assertEqual(client._decode_register(30010), (3, 9))
+        self.assertEqual(client._decode_register(40001), (4, 0))
+        self.assertEqual(client._decode_register(410000), (4, 9999))
+        with self.assertRaises(ValueError):
+            client._decode_register(0)
+        with self.assertRaises(ValueError):
+            client._decode_register(1000000)
+
+    def test_parse_reads(self):
+        self.assertEqual(client._parse_reads('40001', 2), [('40001', 4, 0, 2)])
+        self.assertEqual(
+            client._parse_reads('40010-40012,10001'),
+            [('40010-40012', 4, 9, 3), ('10001', 1, 0, 1)],
+            )
+        with self.assertRaises(ValueError):
+            client._parse_reads('40010-30012')
+        for spec in ('40001-40002-40003', '40001-', '-40001'):
+            with self.assertRaises(ValueError) as context:
+                client._parse_reads(spec)
+            self.assertEqual(str(context.exception), "invalid register range: %s" % (spec,))
+
+    def test_merge_reads(self):
+        reads = client._parse_reads('40003-40005,40001,40002,30001,40200')
+        runs = client._merge_reads(reads)
+        self.assertEqual([run[:3] for run in runs], [(3, 0, 1), (4, 0, 5), (4, 199, 1)])
+        self.assertEqual([offset for _, offset in runs[1][3]], [0, 1, 2])
+
+        # no more than 125 registers in a request
+        runs = client._merge_reads(client._parse_reads('40001-40100,40101-40130'))
+        self.assertEqual([run[:3] for run in runs], [(4, 0, 100), (4, 100, 30)])
+
     def tearDown(self):
         pass
 
@@ -10,6 +10,8 @@ Tests for `modpypes.pdu` module.
 
 import unittest
 
+from bacpypes.comm import PDU
+
 from modpypes import pdu
 
 
@@ -21,6 +23,116 @@ class TestModpypes(unittest.TestCase):
     def test_something(self):
         pass
 
+    def test_type_tables(self):
+        for fn, klass in pdu.request_types.items():
+            self.assertIs(pdu.request_table[fn], klass)
+        for fn, klass in pdu.response_types.items():
+            self.assertIs(pdu.response_table[fn], klass)
+        self.assertIsNone(pdu.response_table[0])
+
+    def test_pack_bits(self):
+        bits = [True, False, True, True, False, False, False, False, True, True]
+        self.assertEqual(pdu._packBitsToString(bits), b'\x0d\x03')
+        self.assertEqual(pdu._unpackBitsFromString(b'\x0d\x03')[:10], bits)
+
+    def test_real_codecs(self):
+        for codec in (pdu.Real(), pdu.BigEndianReal()):
+            self.assertEqual(codec.unpack(codec.pack(1.5)), 1.5)
+        self.assertEqual(pdu.Real().pack(1.5), [0x0000, 0x3FC0])
+        self.assertEqual(pdu.BigEndianReal().pack(1.5), [0x3FC0, 0x0000])
+        self.assertEqual(pdu.ROCReal().unpack([0x0000, 0xC03F]), 1.5)
+
+    def test_signed_codecs(self):
+        self.assertEqual(pdu.Int().unpack([0x7FFF]), 32767)
+        self.assertEqual(pdu.Int().unpack([0x8000]), -32768)
+        self.assertEqual(pdu.DoubleInt().unpack([0xFFFF, 0xFFFE]), -2)
+        self.assertEqual(pdu.BigEndianDoubleInt().unpack([0xFFFE, 0xFFFF]), -2)
+
+    def test_string_codecs(self):
+        registers = [0x4142, 0x4300, 0x4444]
+        self.assertEqual(pdu.String(3).unpack(registers), 'ABC')
+        self.assertEqual(pdu.BigEndianString(3).unpack(registers), 'BA')
+        self.assertEqual(pdu.String(1).unpack([0x4142]), 'AB')
+
+    def test_registers(self):
+        buff = PDU()
+        pdu._put_registers(buff, [1, 0xFFFF, 300])
+        self.assertEqual(buff.pduData, bytearray(b'\x06\x00\x01\xff\xff\x01\x2c'))
+        self.assertEqual(pdu._get_registers(buff), [1, 0xFFFF, 300])
+        self.assertEqual(len(buff.pduData), 0)
+
+    def test_request_fields(self):
+        req = pdu.WriteSingleRegisterRequest(10, -1)
+        buff = PDU()
+        req.encode(buff)
+        self.assertEqual(buff.pduData, bytearray(b'\x00\x0a\xff\xff'))
+
+        req = pdu.ReadWriteMultipleRegistersRequest(1, 2, 3, 1, [4])
+        buff = PDU()
+        req.encode(buff)
+        decoded = pdu.ReadWriteMultipleRegistersRequest()
+        decoded.decode(buff)
+        self.assertEqual((decoded.raddress, decoded.rcount, decoded.waddress, decoded.wcount), (1, 2, 3, 1))
+        self.assertEqual(decoded.registers, [4])
+
+    def test_empty_requests(self):
+        # the server builds requests with no arguments before decoding them
+        req = pdu.WriteMultipleCoilsRequest()
+        self.assertEqual(req.coils, [])
+
+        req = pdu.ReadWriteMultipleRegistersRequest()
+        self.assertEqual(req.registers, [])
+
+    def test_encode_to_pdu(self):
+        req = pdu.WriteMultipleRegistersRequest(10, 3, [1, 2, 3])
+        req.mpduTransactionID = 7
+        req.mpduUnitID = 1
+
+        # the long way around through a generic MPDU
+        mpdu = pdu.MPDU()
+        req.encode(mpdu)
+        expected = PDU()
+        mpdu.encode(expected)
+
+        direct = PDU()
+        req.encode_to_pdu(direct)
+        self.assertEqual(direct.pduData, expected.pduData)
+
+        # and back again
+        decoded = pdu.MPDU()
+        decoded.decode(direct)
+        self.assertEqual(decoded.mpduTransactionID, 7)
+        self.assertEqual(decoded.mpduLength, 13)
+        self.assertEqual(decoded.mpduUnitID, 1)
+        self.assertEqual(decoded.mpduFunctionCode, pdu.WriteMultipleRegistersRequest.functionCode)
+
+    def test_encode_to_pdu_messages(self):
+        messages = [
+            pdu.ReadCoilsRequest(1, 10),
+            pdu.ReadCoilsResponse([True, False, True]),
+            pdu.ReadMultipleRegistersRequest(1, 2),
+            pdu.ReadMultipleRegistersResponse([1, 2]),
+            pdu.WriteSingleCoilRequest(1, 0xFF00),
+            pdu.WriteSingleRegisterResponse(1, 5),
+            pdu.WriteMultipleCoilsRequest(1, 3, [True, False, True]),
+            pdu.WriteMultipleRegistersResponse(1, 3),
+            pdu.ReadWriteMultipleRegistersRequest(1, 2, 3, 1, [4]),
+            pdu.ReadWriteMultipleRegistersResponse([1, 2]),
+            pdu.ExceptionResponse(3, pdu.ExceptionResponse.ILLEGAL_DATA_ADDRESS),
+            ]
+
+        # every message encodes directly into a plain PDU the same way it
+        # does through a generic MPDU
+        for msg in messages:
+            mpdu = pdu.MPDU()
+            msg.encode(mpdu)
+            expected = PDU()
+            mpdu.encode(expected)
+
+            direct = PDU()
+            msg.encode_to_pdu(direct)
+            self.assertEqual(direct.pduData, expected.pduData, msg.__class__.__name__)
+
     def tearDown(self):
         pass
 